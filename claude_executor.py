@@ -1,7 +1,10 @@
 import asyncio
-import json
+import contextlib
 import logging
-from typing import AsyncGenerator, Optional
+import subprocess
+from typing import AsyncGenerator, Optional, Union
+
+import orjson
 
 from config import config
 from models import ChatMessage
@@ -9,6 +12,42 @@ from tool_handler import build_tool_prompt, format_tool_results, get_schema_json
 
 logger = logging.getLogger(__name__)
 
+# Only the end of stderr is kept for error logs
+_STDERR_TAIL_SIZE = 8 * 1024
+
+# Caps concurrently running CLI processes; 0 leaves them unlimited
+_process_slots = (
+    asyncio.Semaphore(config.claude_workers)
+    if config.claude_workers > 0
+    else contextlib.nullcontext()
+)
+
+# Fixed leading arguments for each invocation mode, built once at import
+_BLOCKING_CMD = (
+    config.claude_bin,
+    "-p",  # Print mode (non-interactive)
+    "--dangerously-skip-permissions",  # Full permissions, no user interaction
+    "--output-format", "json",
+    "--max-turns", str(config.max_turns),
+)
+_STREAM_CMD = (
+    config.claude_bin,
+    "-p",
+    "--dangerously-skip-permissions",
+    "--output-format", "stream-json",
+    "--max-turns", str(config.max_turns),
+    "--verbose",  # stream-json requires --verbose flag
+)
+_TOOL_CMD = (
+    config.claude_bin,
+    "-p",
+    "--dangerously-skip-permissions",
+    "--output-format", "json",
+    "--tools", "",  # Disable built-in tools
+    "--json-schema", get_schema_json(),
+    "--max-turns", "3",  # Need at least 2 turns for Claude Code internal processing
+)
+
 
 def merge_messages_to_prompt(messages: list[ChatMessage], include_tool_results: bool = False) -> tuple[str, str]:
     """
@@ -17,11 +56,23 @@ def merge_messages_to_prompt(messages: list[ChatMessage], include_tool_results:
     """
     system_parts = []
     conversation_parts = []
+    # Count of user/assistant turns, and the first user message, so a lone
+    # user turn can be passed through without a role prefix
+    turn_count = 0
+    first_user = None
 
     for msg in messages:
         if msg.role == "system":
             system_parts.append(msg.content or "")
-        elif msg.role == "user":
+            continue
+        if msg.role == "tool":
+            # Tool result messages are handled by format_tool_results
+            continue
+
+        turn_count += 1
+        if msg.role == "user":
+            if first_user is None:
+                first_user = msg
             content = msg.content or ""
             conversation_parts.append(f"User: {content}")
         elif msg.role == "assistant":
@@ -30,29 +81,21 @@ def merge_messages_to_prompt(messages: list[ChatMessage], include_tool_results:
             if msg.tool_calls and include_tool_results:
                 tool_calls_text = []
                 for tc in msg.tool_calls:
-                    tc_dict = tc.model_dump() if hasattr(tc, 'model_dump') else tc
+                    tc_dict = tc.model_dump(exclude_none=True) if hasattr(tc, 'model_dump') else tc
                     func = tc_dict.get("function", {})
                     tool_calls_text.append(f"Called tool: {func.get('name')} with args: {func.get('arguments')}")
                 if tool_calls_text:
                     content = content + "\n" + "\n".join(tool_calls_text) if content else "\n".join(tool_calls_text)
             if content:
                 conversation_parts.append(f"Assistant: {content}")
-        elif msg.role == "tool" and include_tool_results:
-            # Tool result message - will be handled by format_tool_results
-            pass
 
     system_prompt = "\n".join(system_parts) if system_parts else ""
-    user_prompt = "\n\n".join(conversation_parts)
-
-    # If only user messages without role prefix for single message
-    if len(messages) == 1 and messages[0].role == "user":
-        user_prompt = messages[0].content or ""
-    elif len([m for m in messages if m.role not in ("system", "tool")]) == 1:
-        # Single non-system, non-tool message, use content directly
-        for msg in messages:
-            if msg.role == "user":
-                user_prompt = msg.content or ""
-                break
+
+    # Single user turn (ignoring system/tool messages): use content directly
+    if turn_count == 1 and first_user is not None:
+        user_prompt = first_user.content or ""
+    else:
+        user_prompt = "\n\n".join(conversation_parts)
 
     return system_prompt, user_prompt
 
@@ -68,17 +111,7 @@ async def execute_claude_code(
     system_prompt, user_prompt = merge_messages_to_prompt(messages)
 
     # Build command
-    cmd = [
-        config.claude_bin,
-        "-p",  # Print mode (non-interactive)
-        "--dangerously-skip-permissions",  # Full permissions, no user interaction
-        "--output-format", "stream-json" if stream else "json",
-        "--max-turns", str(config.max_turns),
-    ]
-
-    # stream-json requires --verbose flag
-    if stream:
-        cmd.append("--verbose")
+    cmd = list(_STREAM_CMD if stream else _BLOCKING_CMD)
 
     # Add system prompt if present
     if system_prompt:
@@ -87,7 +120,8 @@ async def execute_claude_code(
     # Add the user prompt
     cmd.append(user_prompt)
 
-    logger.info(f"Executing Claude Code: {' '.join(cmd[:6])}... [prompt truncated]")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Executing Claude Code: {' '.join(cmd[:6])}... [prompt truncated]")
 
     try:
         if stream:
@@ -120,20 +154,12 @@ async def execute_claude_code_with_tools(
     system_prompt = (system_prompt + "\n\n" + tool_prompt).strip() if system_prompt else tool_prompt
 
     # Add tool results if any
-    tool_results_text = format_tool_results([m.model_dump() for m in messages])
+    tool_results_text = format_tool_results(messages)
     if tool_results_text:
         user_prompt = user_prompt + "\n\n" + tool_results_text
 
     # Build command - use JSON schema for structured output
-    cmd = [
-        config.claude_bin,
-        "-p",
-        "--dangerously-skip-permissions",
-        "--output-format", "json",
-        "--tools", "",  # Disable built-in tools
-        "--json-schema", get_schema_json(),
-        "--max-turns", "3",  # Need at least 2 turns for Claude Code internal processing
-    ]
+    cmd = list(_TOOL_CMD)
 
     # Add system prompt
     if system_prompt:
@@ -142,41 +168,29 @@ async def execute_claude_code_with_tools(
     # Add user prompt
     cmd.append(user_prompt)
 
-    logger.info(f"Executing Claude Code (tool mode): {' '.join(cmd[:8])}... [prompt truncated]")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Executing Claude Code (tool mode): {' '.join(cmd[:8])}... [prompt truncated]")
 
     # Execute
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
+    returncode, stdout, stderr = await _run_to_completion(cmd)
 
-    try:
-        stdout, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=config.timeout
-        )
-    except asyncio.TimeoutError:
-        process.kill()
-        await process.wait()
-        raise TimeoutError(f"Claude Code execution timed out after {config.timeout}s")
-
-    if process.returncode != 0:
-        error_msg = stderr.decode() if stderr else "Unknown error"
+    if returncode != 0:
+        error_msg = stderr.decode(errors="replace") if stderr else "Unknown error"
         logger.error(f"Claude Code (tool mode) returned non-zero: {error_msg}")
         if not stdout:
             raise RuntimeError(f"Claude Code error: {error_msg}")
 
-    output = stdout.decode()
-    logger.debug(f"Claude Code (tool mode) raw output: {output[:500]}...")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Claude Code (tool mode) raw output: {stdout[:500].decode(errors='replace')}...")
 
-    # Parse JSON output
+    # Parse JSON output straight from the raw bytes
     try:
-        data = json.loads(output)
+        data = orjson.loads(stdout)
         return data
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Failed to parse Claude Code JSON output: {e}")
         # Return a fallback response
+        output = stdout.decode(errors="replace")
         return {
             "result": output,
             "structured_output": {
@@ -188,104 +202,239 @@ async def execute_claude_code_with_tools(
 
 async def _execute_blocking(cmd: list[str]) -> str:
     """Execute command and return full response."""
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
+    returncode, stdout, stderr = await _run_to_completion(cmd)
 
-    try:
-        stdout, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=config.timeout
-        )
-    except asyncio.TimeoutError:
-        process.kill()
-        await process.wait()
-        raise TimeoutError(f"Claude Code execution timed out after {config.timeout}s")
-
-    if process.returncode != 0:
-        error_msg = stderr.decode() if stderr else "Unknown error"
+    if returncode != 0:
+        error_msg = stderr.decode(errors="replace") if stderr else "Unknown error"
         logger.error(f"Claude Code returned non-zero: {error_msg}")
         # Still try to parse stdout if available
         if not stdout:
             raise RuntimeError(f"Claude Code error: {error_msg}")
 
-    output = stdout.decode()
-
-    # Parse JSON output
+    # Parse JSON output straight from the raw bytes; only decode the whole
+    # output when it has to be returned as-is
     try:
-        data = json.loads(output)
-        # Extract result from Claude Code JSON response
-        if isinstance(data, dict):
-            if "result" in data:
-                return data["result"]
-            elif "content" in data:
-                return data["content"]
-            elif "message" in data:
-                return data["message"]
-        return output
-    except json.JSONDecodeError:
+        data = orjson.loads(stdout)
+    except orjson.JSONDecodeError:
         # Return raw output if not valid JSON
-        return output
+        return stdout.decode(errors="replace")
 
+    # Extract result from Claude Code JSON response
+    if isinstance(data, dict):
+        if "result" in data:
+            return data["result"]
+        elif "content" in data:
+            return data["content"]
+        elif "message" in data:
+            return data["message"]
+    return stdout.decode(errors="replace")
 
-async def _execute_streaming(cmd: list[str]) -> AsyncGenerator[str, None]:
-    """Execute command and stream response chunks."""
-    process = await asyncio.create_subprocess_exec(
+
+class _ClaudeProcessProtocol(asyncio.SubprocessProtocol):
+    """
+    Subprocess protocol that appends stdout straight into one bytearray,
+    skipping the StreamReader that asyncio.subprocess.PIPE would set up.
+    stderr is drained as it arrives, keeping only its tail for error logs.
+    """
+
+    def __init__(self, limit: int):
+        self.buffer = bytearray()
+        self.stderr_tail = bytearray()
+        self.eof = False
+        self._limit = limit
+        self._loop = asyncio.get_running_loop()
+        self._exited = self._loop.create_future()
+        self._waiter: Optional[asyncio.Future] = None
+        self._transport: Optional[asyncio.SubprocessTransport] = None
+        self._paused = False
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def pipe_data_received(self, fd, data):
+        if fd == 2:
+            self.stderr_tail += data
+            if len(self.stderr_tail) > _STDERR_TAIL_SIZE:
+                del self.stderr_tail[:-_STDERR_TAIL_SIZE]
+            return
+        self.buffer += data
+        # Stop reading the pipe while the consumer is behind
+        if len(self.buffer) > self._limit and not self._paused:
+            self._set_reading(False)
+        self._wake()
+
+    def pipe_connection_lost(self, fd, exc):
+        if fd == 1:
+            self.eof = True
+            self._wake()
+
+    def process_exited(self):
+        if not self._exited.done():
+            self._exited.set_result(None)
+
+    async def wait_for_data(self):
+        """Wait until more stdout has arrived or the pipe has closed."""
+        if self._paused:
+            self._set_reading(True)
+        if self.eof:
+            return
+        self._waiter = self._loop.create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+
+    async def wait_exited(self):
+        """Wait for the process to exit."""
+        await self._exited
+
+    async def wait_finished(self):
+        """Wait for stdout to close and the process to exit."""
+        while not self.eof:
+            await self.wait_for_data()
+        await self._exited
+
+    def _set_reading(self, reading: bool):
+        pipe = self._transport.get_pipe_transport(1)
+        if pipe is not None:
+            if reading:
+                pipe.resume_reading()
+            else:
+                pipe.pause_reading()
+        self._paused = not reading
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+async def _spawn(cmd: list[str]) -> tuple[asyncio.SubprocessTransport, _ClaudeProcessProtocol]:
+    """Start command with stdout and stderr piped into a _ClaudeProcessProtocol."""
+    loop = asyncio.get_running_loop()
+    return await loop.subprocess_exec(
+        lambda: _ClaudeProcessProtocol(config.stream_buffer_limit),
         *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
+        stdin=None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
     )
 
-    buffer = ""
 
-    try:
-        while True:
-            chunk = await asyncio.wait_for(
-                process.stdout.read(1024),
-                timeout=config.timeout
-            )
+@contextlib.asynccontextmanager
+async def _claude_process(cmd: list[str]):
+    """
+    Start command once a process slot is free, and hold the slot until the
+    block exits. The transport is closed on exit; callers wait for the
+    process to exit first.
+    """
+    async with _process_slots:
+        transport, protocol = await _spawn(cmd)
+        try:
+            yield transport, protocol
+        finally:
+            transport.close()
+
+
+async def _run_to_completion(cmd: list[str]) -> tuple[int, bytearray, bytes]:
+    """
+    Run command until it exits, draining stdout and stderr concurrently.
+    Returns (returncode, stdout, stderr tail).
+    """
+    async with _claude_process(cmd) as (transport, protocol):
+        try:
+            await asyncio.wait_for(protocol.wait_finished(), timeout=config.timeout)
+        except asyncio.TimeoutError:
+            try:
+                transport.kill()
+            except ProcessLookupError:
+                pass
+            await protocol.wait_exited()
+            raise TimeoutError(f"Claude Code execution timed out after {config.timeout}s")
 
-            if not chunk:
-                break
+        return transport.get_returncode(), protocol.buffer, bytes(protocol.stderr_tail)
 
-            buffer += chunk.decode()
 
-            # Process complete JSON lines (stream-json format is newline-delimited)
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                line = line.strip()
+async def _execute_streaming(cmd: list[str]) -> AsyncGenerator[str, None]:
+    """Execute command and stream response chunks."""
+    loop = asyncio.get_running_loop()
 
-                if not line:
-                    continue
+    async with _claude_process(cmd) as (transport, protocol):
+        timed_out = False
 
-                try:
-                    data = json.loads(line)
-                    # Extract content from streaming event
-                    content = _extract_streaming_content(data)
-                    if content:
-                        yield content
-                except json.JSONDecodeError:
-                    # Non-JSON line, yield as-is
-                    if line:
-                        yield line
-
-        # Process remaining buffer
-        if buffer.strip():
+        def on_timeout():
+            nonlocal timed_out
+            timed_out = True
             try:
-                data = json.loads(buffer.strip())
-                content = _extract_streaming_content(data)
+                transport.kill()
+            except ProcessLookupError:
+                pass
+
+        # A single deadline for the whole stream rather than a timer per read:
+        # killing the process closes stdout, which ends the read loop below.
+        timeout_handle = loop.call_later(config.timeout, on_timeout)
+
+        # Lines are sliced straight out of the protocol's buffer; `start` marks
+        # the first unconsumed byte and `scan_from` where the newline search
+        # resumes, so each byte is scanned once.
+        buffer = protocol.buffer
+        start = 0
+        scan_from = 0
+        finished = False
+
+        try:
+            while not timed_out:
+                nl = buffer.find(b"\n", scan_from)
+                if nl == -1:
+                    if protocol.eof:
+                        break
+                    # Drop consumed lines, then wait for more output
+                    del buffer[:start]
+                    start = 0
+                    scan_from = len(buffer)
+                    await protocol.wait_for_data()
+                    continue
+
+                line = buffer[start:nl + 1]
+                start = scan_from = nl + 1
+
+                content = _parse_streaming_line(line)
                 if content:
                     yield content
-            except json.JSONDecodeError:
-                yield buffer.strip()
-
-    except asyncio.TimeoutError:
-        process.kill()
-        raise TimeoutError(f"Claude Code streaming timed out after {config.timeout}s")
-    finally:
-        await process.wait()
+
+            # Trailing line without a newline
+            if not timed_out and start < len(buffer):
+                content = _parse_streaming_line(buffer[start:])
+                if content:
+                    yield content
+
+            finished = True
+            if timed_out:
+                raise TimeoutError(f"Claude Code streaming timed out after {config.timeout}s")
+        finally:
+            timeout_handle.cancel()
+            # Stop the CLI if the consumer went away before the output ended
+            if not finished:
+                try:
+                    transport.kill()
+                except ProcessLookupError:
+                    pass
+            await protocol.wait_exited()
+
+
+def _parse_streaming_line(line: Union[bytes, bytearray]) -> Optional[str]:
+    """
+    Parse one raw stream-json line and return its text content, if any.
+    The line is handed to the parser as-is (JSON allows the trailing
+    newline); only extracted text or non-JSON lines are ever decoded.
+    """
+    try:
+        data = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        # Non-JSON line, yield as-is
+        return line.decode(errors="replace").strip() or None
+
+    # Extract content from streaming event
+    return _extract_streaming_content(data)
 
 
 def _extract_streaming_content(data: dict) -> Optional[str]:
@@ -1,46 +1,65 @@
+import functools
 import os
 import shutil
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
-@dataclass
+@functools.cache
+def _resolve_claude_bin(name: str) -> str:
+    """
+    Resolve the claude binary to an absolute path, so each request execs it
+    directly instead of searching PATH on every spawn.
+    Names that can't be resolved are kept, letting exec report them missing.
+    """
+    claude_path = shutil.which(name)
+    if claude_path:
+        return os.path.abspath(claude_path)
+    return name
+
+
+def _env(name: str, default):
+    """Dataclass field read from an environment variable, typed like its default."""
+    return field(default_factory=lambda: type(default)(os.environ.get(name, default)))
+
+
+@dataclass(frozen=True)
 class Config:
-    """Configuration for Claude OpenAI Proxy"""
+    """Configuration for Claude OpenAI Proxy, read from the environment"""
 
     # Server settings
-    host: str = "0.0.0.0"
-    port: int = 18880
+    host: str = _env("PROXY_HOST", "0.0.0.0")
+    port: int = _env("PROXY_PORT", 18880)
+    workers: int = _env("PROXY_WORKERS", 1)  # uvicorn worker processes
+    cors_enabled: bool = field(default_factory=lambda: os.environ.get("PROXY_CORS", "1") != "0")
 
-    # Claude Code CLI path
-    claude_bin: str = ""
+    # Claude Code CLI path (auto-detected from PATH by default)
+    claude_bin: str = field(
+        default_factory=lambda: _resolve_claude_bin(os.environ.get("CLAUDE_BIN", "") or "claude")
+    )
 
     # Optional auth token (empty = no auth)
-    proxy_token: str = ""
+    proxy_token: str = _env("CLAUDE_PROXY_TOKEN", "")
 
     # Model name exposed to clients
     model_name: str = "claude-code"
     model_display_name: str = "Claude Code Proxy (local)"
 
     # Claude Code CLI options
-    max_turns: int = 10
-    timeout: int = 300  # seconds
-
-    def __post_init__(self):
-        # Try to find claude binary
-        self.claude_bin = os.environ.get("CLAUDE_BIN", "")
-        if not self.claude_bin:
-            # Try to find in PATH
-            claude_path = shutil.which("claude")
-            if claude_path:
-                self.claude_bin = claude_path
-            else:
-                self.claude_bin = "claude"  # Assume it's in PATH
-
-        self.proxy_token = os.environ.get("CLAUDE_PROXY_TOKEN", "")
-        self.host = os.environ.get("PROXY_HOST", self.host)
-        self.port = int(os.environ.get("PROXY_PORT", self.port))
-        self.max_turns = int(os.environ.get("CLAUDE_MAX_TURNS", self.max_turns))
-        self.timeout = int(os.environ.get("CLAUDE_TIMEOUT", self.timeout))
+    max_turns: int = _env("CLAUDE_MAX_TURNS", 10)
+    timeout: int = _env("CLAUDE_TIMEOUT", 300)  # seconds
+    claude_workers: int = _env("PROXY_CLAUDE_WORKERS", 0)  # concurrent CLI processes, 0 = unlimited
+
+    # Unconsumed stdout allowed before the subprocess pipe is paused
+    stream_buffer_limit: int = _env("CLAUDE_STREAM_BUFFER_LIMIT", 1024 * 1024)  # bytes
+
+    # Streaming response coalescing (0 ms disables)
+    stream_coalesce_chars: int = _env("PROXY_STREAM_COALESCE_CHARS", 256)
+    stream_coalesce_ms: int = _env("PROXY_STREAM_COALESCE_MS", 20)
+
+    @functools.cached_property
+    def proxy_token_bytes(self) -> bytes:
+        """UTF-8 encoded proxy token, for constant-time comparison."""
+        return self.proxy_token.encode()
 
 
 config = Config()
@@ -18,20 +18,29 @@ Environment Variables:
     CLAUDE_PROXY_TOKEN: Optional auth token (default: no auth)
     PROXY_HOST: Server host (default: 0.0.0.0)
     PROXY_PORT: Server port (default: 18880)
+    PROXY_WORKERS: Server worker processes (default: 1)
+    PROXY_CORS: Set to 0 to disable CORS headers (default: 1)
     CLAUDE_MAX_TURNS: Max agentic turns (default: 10)
     CLAUDE_TIMEOUT: Execution timeout in seconds (default: 300)
+    PROXY_CLAUDE_WORKERS: Max concurrent CLI processes per worker, 0 = unlimited (default: 0)
+    CLAUDE_STREAM_BUFFER_LIMIT: Subprocess stdout buffer limit (default: 1048576)
+    PROXY_STREAM_COALESCE_CHARS: Flush streamed text at this many chars (default: 256)
+    PROXY_STREAM_COALESCE_MS: Max delay before flushing streamed text, 0 disables (default: 20)
 """
 
+import asyncio
+import contextlib
+import hmac
 import logging
 import time
-import uuid
-from typing import Optional
+from typing import AsyncGenerator, Optional
 
+import orjson
 from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from sse_starlette.sse import EventSourceResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
 
 from config import config
 from models import (
@@ -47,6 +56,7 @@ from models import (
     Usage,
     ModelInfo,
     ModelListResponse,
+    rand_id,
 )
 from claude_executor import execute_claude_code, execute_claude_code_with_tools
 from tool_handler import parse_structured_output
@@ -58,6 +68,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Queue marker for the end of a drained stream, and the queue's capacity
+_STREAM_END = object()
+_STREAM_QUEUE_SIZE = 64
+
+# Server-sent events are written as pre-encoded bytes
+_SSE_HEADERS = {
+    "Cache-Control": "no-store",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+_SSE_DONE = b"data: [DONE]\n\n"
+_SSE_PING = b": ping\n\n"
+_SSE_PING_INTERVAL = 15  # seconds
+
 # Create FastAPI app
 app = FastAPI(
     title="Claude Code OpenAI Proxy",
@@ -65,26 +89,31 @@ app = FastAPI(
     version="1.1.0",
 )
 
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Add CORS middleware, for browser clients; the API only has GET and POST
+# routes. Request headers stay open since OpenAI SDKs send their own.
+if config.cors_enabled:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["GET", "POST"],
+        allow_headers=["*"],
+    )
 
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     """Log validation errors with request body for debugging."""
-    body = await request.body()
-    logger.error(f"Validation error for {request.url.path}")
-    logger.error(f"Request body: {body.decode()[:2000]}")
-    logger.error(f"Validation errors: {exc.errors()}")
+    errors = exc.errors()
+    if logger.isEnabledFor(logging.ERROR):
+        # Only the logged prefix of the body is decoded
+        body = await request.body()
+        logger.error("Validation error for %s", request.url.path)
+        logger.error("Request body: %s", body[:2000].decode("utf-8", errors="replace"))
+        logger.error("Validation errors: %s", errors)
     return JSONResponse(
         status_code=422,
-        content={"detail": exc.errors()},
+        content={"detail": errors},
     )
 
 
@@ -97,11 +126,10 @@ def verify_token(authorization: Optional[str]) -> bool:
         return False
 
     # Support both "Bearer token" and raw token
-    token = authorization
-    if authorization.startswith("Bearer "):
-        token = authorization[7:]
+    token = authorization.removeprefix("Bearer ")
 
-    return token == config.proxy_token
+    # Constant-time comparison so response timing doesn't leak the token
+    return hmac.compare_digest(token.encode(), config.proxy_token_bytes)
 
 
 @app.get("/")
@@ -122,15 +150,15 @@ async def list_models(authorization: Optional[str] = Header(None)):
     if not verify_token(authorization):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    return ModelListResponse(
+    return _json_response(ModelListResponse.model_construct(
         data=[
-            ModelInfo(
+            ModelInfo.model_construct(
                 id=config.model_name,
                 created=int(time.time()),
                 owned_by="claude-code-proxy",
             )
         ]
-    )
+    ))
 
 
 @app.post("/v1/chat/completions")
@@ -146,39 +174,91 @@ async def chat_completions(
     if not verify_token(authorization):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    request_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    request_id = f"chatcmpl-{rand_id()}"
 
     has_tools = request.tools and len(request.tools) > 0
-    logger.info(f"Request {request_id}: model={request.model}, messages={len(request.messages)}, stream={request.stream}, tools={has_tools}")
-    if has_tools:
+    logger.info(
+        "Request %s: model=%s, messages=%d, stream=%s, tools=%s",
+        request_id, request.model, len(request.messages), request.stream, has_tools,
+    )
+    if has_tools and logger.isEnabledFor(logging.DEBUG):
         tool_names = [t.function.name for t in request.tools]
-        logger.info(f"Request {request_id}: Tool names: {tool_names}")
+        logger.debug("Request %s: Tool names: %s", request_id, tool_names)
 
     # Tool calling mode
     if has_tools:
-        logger.info(f"Request {request_id}: Tool calling mode with {len(request.tools)} tools")
+        logger.info("Request %s: Tool calling mode with %d tools", request_id, len(request.tools))
         if request.stream:
             # Wrap tool response in SSE format for streaming clients
-            return EventSourceResponse(
-                _tool_calling_stream_response(request_id, request),
-                media_type="text/event-stream",
-            )
-        return await _tool_calling_response(request_id, request)
+            return _sse_response(_tool_calling_stream_response(request_id, request))
+        return _json_response(await _tool_calling_response(request_id, request))
 
     # Normal mode
     if request.stream:
-        return EventSourceResponse(
-            _stream_response(request_id, request),
-            media_type="text/event-stream",
-        )
+        return _sse_response(_stream_response(request_id, request))
     else:
-        return await _blocking_response(request_id, request)
+        return _json_response(await _blocking_response(request_id, request))
+
+
+def _json_response(model: BaseModel) -> Response:
+    """
+    Serialize a response model with pydantic-core directly, so FastAPI
+    doesn't walk it through jsonable_encoder before encoding.
+    """
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
+def _sse_response(events: AsyncGenerator[bytes, None]) -> StreamingResponse:
+    """Stream pre-encoded server-sent events, with keepalive pings."""
+    return StreamingResponse(
+        _sse_keepalive(events),
+        media_type="text/event-stream",
+        headers=_SSE_HEADERS,
+    )
+
+
+def _sse_event(chunk: BaseModel) -> bytes:
+    """Encode a response chunk as a server-sent event."""
+    return b"data: " + chunk.model_dump_json().encode() + b"\n\n"
+
+
+async def _sse_keepalive(events: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """
+    Pass `events` through, sending a comment line whenever it has been
+    silent for _SSE_PING_INTERVAL so proxies keep the connection open while
+    Claude Code is still working. One background task drains `events` into
+    a queue; ready events are taken without waiting, so the timed wait only
+    happens while the stream is idle.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+    producer = asyncio.create_task(_produce_chunks(events, queue))
+
+    try:
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                try:
+                    item = await asyncio.wait_for(queue.get(), _SSE_PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield _SSE_PING
+                    continue
+            if item is _STREAM_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # The client may disconnect while the next event is being produced
+        producer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await producer
 
 
 async def _tool_calling_response(request_id: str, request: ChatCompletionRequest) -> ChatCompletionResponse:
     """Generate a response with potential tool calls."""
     # Convert tools to dict format
-    tools_dict = [t.model_dump() for t in request.tools]
+    tools_dict = [t.model_dump(exclude_none=True) for t in request.tools]
 
     # Execute with tool support
     raw_response = await execute_claude_code_with_tools(request.messages, tools_dict)
@@ -186,18 +266,22 @@ async def _tool_calling_response(request_id: str, request: ChatCompletionRequest
     # Parse structured output
     content, tool_calls = parse_structured_output(raw_response)
 
-    logger.info(f"Request {request_id}: Tool response - content={bool(content)}, tool_calls={len(tool_calls)}")
+    logger.info(
+        "Request %s: Tool response - content=%s, tool_calls=%d",
+        request_id, bool(content), len(tool_calls),
+    )
     if content and not tool_calls:
-        logger.info(f"Request {request_id}: Text response: {content[:200]}...")
+        logger.debug("Request %s: Text response: %.200s...", request_id, content)
 
-    # Build response
+    # Build response. Everything below comes from parse_structured_output,
+    # so the models are constructed without re-running validation.
     if tool_calls:
         # Convert tool_calls to proper format
         formatted_tool_calls = [
-            ToolCall(
+            ToolCall.model_construct(
                 id=tc["id"],
                 type=tc["type"],
-                function=FunctionCall(
+                function=FunctionCall.model_construct(
                     name=tc["function"]["name"],
                     arguments=tc["function"]["arguments"]
                 )
@@ -205,13 +289,13 @@ async def _tool_calling_response(request_id: str, request: ChatCompletionRequest
             for tc in tool_calls
         ]
 
-        return ChatCompletionResponse(
+        return ChatCompletionResponse.model_construct(
             id=request_id,
             model=request.model,
             choices=[
-                ChatCompletionChoice(
+                ChatCompletionChoice.model_construct(
                     index=0,
-                    message=ResponseMessage(
+                    message=ResponseMessage.model_construct(
                         role="assistant",
                         content=content,
                         tool_calls=formatted_tool_calls,
@@ -222,13 +306,13 @@ async def _tool_calling_response(request_id: str, request: ChatCompletionRequest
             usage=_estimate_usage(request, content or ""),
         )
     else:
-        return ChatCompletionResponse(
+        return ChatCompletionResponse.model_construct(
             id=request_id,
             model=request.model,
             choices=[
-                ChatCompletionChoice(
+                ChatCompletionChoice.model_construct(
                     index=0,
-                    message=ResponseMessage(
+                    message=ResponseMessage.model_construct(
                         role="assistant",
                         content=content or "",
                     ),
@@ -244,48 +328,52 @@ async def _tool_calling_stream_response(request_id: str, request: ChatCompletion
     # Get the blocking response first
     response = await _tool_calling_response(request_id, request)
 
-    # Convert to streaming chunks
+    # Convert to streaming chunks, all stamped with the response's time
     choice = response.choices[0]
+    created = response.created
 
     # Send initial chunk with role
-    initial_chunk = ChatCompletionChunk(
+    initial_chunk = ChatCompletionChunk.model_construct(
         id=request_id,
+        created=created,
         model=request.model,
         choices=[
-            ChatCompletionChunkChoice(
+            ChatCompletionChunkChoice.model_construct(
                 index=0,
-                delta=ChatCompletionChunkDelta(role="assistant"),
+                delta=ChatCompletionChunkDelta.model_construct(role="assistant"),
                 finish_reason=None,
             )
         ],
     )
-    yield {"data": initial_chunk.model_dump_json()}
+    yield _sse_event(initial_chunk)
 
     # Send content if present
     if choice.message.content:
-        content_chunk = ChatCompletionChunk(
+        content_chunk = ChatCompletionChunk.model_construct(
             id=request_id,
+            created=created,
             model=request.model,
             choices=[
-                ChatCompletionChunkChoice(
+                ChatCompletionChunkChoice.model_construct(
                     index=0,
-                    delta=ChatCompletionChunkDelta(content=choice.message.content),
+                    delta=ChatCompletionChunkDelta.model_construct(content=choice.message.content),
                     finish_reason=None,
                 )
             ],
         )
-        yield {"data": content_chunk.model_dump_json()}
+        yield _sse_event(content_chunk)
 
     # Send tool_calls if present
     if choice.message.tool_calls:
         for tc in choice.message.tool_calls:
-            tool_chunk = ChatCompletionChunk(
+            tool_chunk = ChatCompletionChunk.model_construct(
                 id=request_id,
+                created=created,
                 model=request.model,
                 choices=[
-                    ChatCompletionChunkChoice(
+                    ChatCompletionChunkChoice.model_construct(
                         index=0,
-                        delta=ChatCompletionChunkDelta(
+                        delta=ChatCompletionChunkDelta.model_construct(
                             tool_calls=[{
                                 "index": 0,
                                 "id": tc.id,
@@ -300,22 +388,23 @@ async def _tool_calling_stream_response(request_id: str, request: ChatCompletion
                     )
                 ],
             )
-            yield {"data": tool_chunk.model_dump_json()}
+            yield _sse_event(tool_chunk)
 
     # Send final chunk
-    final_chunk = ChatCompletionChunk(
+    final_chunk = ChatCompletionChunk.model_construct(
         id=request_id,
+        created=created,
         model=request.model,
         choices=[
-            ChatCompletionChunkChoice(
+            ChatCompletionChunkChoice.model_construct(
                 index=0,
-                delta=ChatCompletionChunkDelta(),
+                delta=ChatCompletionChunkDelta.model_construct(),
                 finish_reason=choice.finish_reason,
             )
         ],
     )
-    yield {"data": final_chunk.model_dump_json()}
-    yield {"data": "[DONE]"}
+    yield _sse_event(final_chunk)
+    yield _SSE_DONE
 
 
 async def _blocking_response(request_id: str, request: ChatCompletionRequest) -> ChatCompletionResponse:
@@ -327,13 +416,13 @@ async def _blocking_response(request_id: str, request: ChatCompletionRequest) ->
 
     full_content = "".join(content_parts)
 
-    return ChatCompletionResponse(
+    return ChatCompletionResponse.model_construct(
         id=request_id,
         model=request.model,
         choices=[
-            ChatCompletionChoice(
+            ChatCompletionChoice.model_construct(
                 index=0,
-                message=ResponseMessage(
+                message=ResponseMessage.model_construct(
                     role="assistant",
                     content=full_content,
                 ),
@@ -346,50 +435,134 @@ async def _blocking_response(request_id: str, request: ChatCompletionRequest) ->
 
 async def _stream_response(request_id: str, request: ChatCompletionRequest):
     """Generate a streaming SSE response."""
+    created = int(time.time())
+
     # Send initial chunk with role
-    initial_chunk = ChatCompletionChunk(
+    initial_chunk = ChatCompletionChunk.model_construct(
         id=request_id,
+        created=created,
         model=request.model,
         choices=[
-            ChatCompletionChunkChoice(
+            ChatCompletionChunkChoice.model_construct(
                 index=0,
-                delta=ChatCompletionChunkDelta(role="assistant"),
+                delta=ChatCompletionChunkDelta.model_construct(role="assistant"),
                 finish_reason=None,
             )
         ],
     )
-    yield {"data": initial_chunk.model_dump_json()}
-
-    # Stream content chunks
-    async for content in execute_claude_code(request.messages, stream=True):
+    yield _sse_event(initial_chunk)
+
+    # Stream content chunks. These differ only in their text, so the JSON
+    # envelope is rendered once and each escaped fragment spliced into it.
+    chunk_prefix = (
+        f'data: {{"id":{orjson.dumps(request_id).decode()},"object":"chat.completion.chunk",'
+        f'"created":{created},"model":{orjson.dumps(request.model).decode()},'
+        f'"choices":[{{"index":0,"delta":{{"role":null,"content":'
+    ).encode()
+    chunk_suffix = b',"tool_calls":null},"finish_reason":null}]}\n\n'
+
+    chunks = _coalesce_chunks(execute_claude_code(request.messages, stream=True))
+    async for content in chunks:
         if content:
-            chunk = ChatCompletionChunk(
-                id=request_id,
-                model=request.model,
-                choices=[
-                    ChatCompletionChunkChoice(
-                        index=0,
-                        delta=ChatCompletionChunkDelta(content=content),
-                        finish_reason=None,
-                    )
-                ],
-            )
-            yield {"data": chunk.model_dump_json()}
+            yield chunk_prefix + orjson.dumps(content) + chunk_suffix
 
     # Send final chunk with finish_reason
-    final_chunk = ChatCompletionChunk(
+    final_chunk = ChatCompletionChunk.model_construct(
         id=request_id,
+        created=created,
         model=request.model,
         choices=[
-            ChatCompletionChunkChoice(
+            ChatCompletionChunkChoice.model_construct(
                 index=0,
-                delta=ChatCompletionChunkDelta(),
+                delta=ChatCompletionChunkDelta.model_construct(),
                 finish_reason="stop",
             )
         ],
     )
-    yield {"data": final_chunk.model_dump_json()}
-    yield {"data": "[DONE]"}
+    yield _sse_event(final_chunk)
+    yield _SSE_DONE
+
+
+async def _coalesce_chunks(chunks: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+    """
+    Merge small content fragments into fewer, larger ones.
+    A background task drains `chunks` into a queue while batches are sent,
+    and a batch is flushed once it holds PROXY_STREAM_COALESCE_CHARS
+    characters or its oldest fragment has waited PROXY_STREAM_COALESCE_MS.
+    """
+    if config.stream_coalesce_ms <= 0:
+        async for content in chunks:
+            yield content
+        return
+
+    loop = asyncio.get_running_loop()
+    max_delay = config.stream_coalesce_ms / 1000
+    # Bounded, so a stalled client pauses the producer (and through it the
+    # CLI's stdout pipe) instead of queueing its output in memory
+    queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+    producer = asyncio.create_task(_produce_chunks(chunks, queue))
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+
+            batch = [item]
+            batch_size = len(item)
+            flush_at = loop.time() + max_delay
+            end = None
+
+            while batch_size < config.stream_coalesce_chars:
+                # Take what is already queued without setting up a timeout
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = flush_at - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STREAM_END or isinstance(item, BaseException):
+                    end = item
+                    break
+                batch.append(item)
+                batch_size += len(item)
+
+            yield "".join(batch)
+
+            if end is _STREAM_END:
+                break
+            if end is not None:
+                raise end
+    finally:
+        # The client may disconnect while the producer is still reading
+        producer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await producer
+
+
+async def _produce_chunks(chunks: AsyncGenerator, queue: asyncio.Queue):
+    """Move non-empty chunks or events into `queue`, then an error or _STREAM_END."""
+    try:
+        async for content in chunks:
+            if content:
+                await queue.put(content)
+    except Exception as e:
+        await queue.put(e)
+    else:
+        await queue.put(_STREAM_END)
+    finally:
+        await chunks.aclose()
+
+
+def _estimate_tokens(text: str) -> int:
+    """Approximate token count using the ~4 characters per token heuristic."""
+    return (len(text) + 3) // 4
 
 
 def _estimate_usage(request: ChatCompletionRequest, completion: str) -> Usage:
@@ -397,11 +570,11 @@ def _estimate_usage(request: ChatCompletionRequest, completion: str) -> Usage:
     prompt_tokens = 0
     for m in request.messages:
         if m.content:
-            prompt_tokens += len(str(m.content).split()) * 2
+            prompt_tokens += _estimate_tokens(m.content)
 
-    completion_tokens = len(completion.split()) * 2
+    completion_tokens = _estimate_tokens(completion)
 
-    return Usage(
+    return Usage.model_construct(
         prompt_tokens=prompt_tokens,
         completion_tokens=completion_tokens,
         total_tokens=prompt_tokens + completion_tokens,
@@ -412,14 +585,18 @@ if __name__ == "__main__":
     import uvicorn
 
     logger.info(f"Starting Claude Code OpenAI Proxy on {config.host}:{config.port}")
+    logger.info(f"Workers: {config.workers}")
     logger.info(f"Claude binary: {config.claude_bin}")
     logger.info(f"Model name: {config.model_name}")
     logger.info(f"Auth required: {bool(config.proxy_token)}")
     logger.info("Features: chat, streaming, tool_calling")
 
+    # Multiple workers need the app as an import string, so each worker
+    # process imports it itself. Startup is only logged here, by the parent.
     uvicorn.run(
-        app,
+        "main:app" if config.workers > 1 else app,
         host=config.host,
         port=config.port,
+        workers=config.workers,
         log_level="info",
     )
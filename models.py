@@ -1,26 +1,10 @@
 from typing import List, Optional, Union, Literal, Any
-from pydantic import BaseModel, Field, field_validator, model_validator
+from pydantic import BaseModel, Field, model_validator
+import os
 import time
 
 
-class ContentBlock(BaseModel):
-    """Content block for multimodal messages."""
-    type: str
-    text: Optional[str] = None
-    image_url: Optional[dict] = None
-
-
 # Tool-related models
-class ToolFunctionParameters(BaseModel):
-    """Parameters schema for a tool function."""
-    type: str = "object"
-    properties: Optional[dict] = None
-    required: Optional[List[str]] = None
-
-    class Config:
-        extra = "allow"
-
-
 class ToolFunction(BaseModel):
     """Function definition for a tool."""
     name: str
@@ -48,35 +32,13 @@ class ToolCall(BaseModel):
 
 
 class ChatMessage(BaseModel):
-    """Chat message supporting string, content blocks, tool calls, and tool results."""
+    """Chat message supporting string content, tool calls, and tool results."""
     role: Literal["system", "user", "assistant", "tool"]
-    content: Optional[Union[str, List[Any]]] = None
+    content: Optional[str] = None  # Content block arrays are flattened by ChatCompletionRequest
     tool_calls: Optional[List[ToolCall]] = None
     tool_call_id: Optional[str] = None  # For tool result messages
     name: Optional[str] = None  # Tool name for tool result messages
 
-    @field_validator("content", mode="before")
-    @classmethod
-    def normalize_content(cls, v):
-        """Convert content blocks array to string."""
-        if v is None:
-            return None
-        if isinstance(v, str):
-            return v
-        if isinstance(v, list):
-            # Extract text from content blocks
-            texts = []
-            for block in v:
-                if isinstance(block, dict):
-                    if block.get("type") == "text" and "text" in block:
-                        texts.append(block["text"])
-                    elif "text" in block:
-                        texts.append(block["text"])
-                elif isinstance(block, str):
-                    texts.append(block)
-            return "\n".join(texts) if texts else ""
-        return str(v) if v else ""
-
     def get_content_str(self) -> str:
         """Get content as string."""
         if isinstance(self.content, str):
@@ -84,6 +46,22 @@ class ChatMessage(BaseModel):
         return ""
 
 
+def _normalize_content(content: Any) -> str:
+    """Convert a content blocks array (or other non-string content) to a string."""
+    if not isinstance(content, list):
+        return str(content) if content else ""
+
+    # Extract text from content blocks
+    texts = []
+    for block in content:
+        if isinstance(block, dict):
+            if "text" in block:
+                texts.append(block["text"])
+        elif isinstance(block, str):
+            texts.append(block)
+    return "\n".join(texts)
+
+
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: List[ChatMessage]
@@ -99,6 +77,28 @@ class ChatCompletionRequest(BaseModel):
     tools: Optional[List[Tool]] = None
     tool_choice: Optional[Union[str, dict]] = None
 
+    @model_validator(mode="before")
+    @classmethod
+    def normalize_message_content(cls, data):
+        """
+        Flatten content block arrays to strings in one pass over the messages.
+        The caller's data is left untouched; only messages whose content
+        changes are copied.
+        """
+        if not isinstance(data, dict) or not isinstance(data.get("messages"), list):
+            return data
+
+        messages = []
+        changed = False
+        for msg in data["messages"]:
+            if isinstance(msg, dict):
+                content = msg.get("content")
+                if content is not None and not isinstance(content, str):
+                    msg = {**msg, "content": _normalize_content(content)}
+                    changed = True
+            messages.append(msg)
+        return {**data, "messages": messages} if changed else data
+
 
 class ResponseMessage(BaseModel):
     """Message in completion response, may include tool_calls."""
@@ -158,3 +158,31 @@ class ModelInfo(BaseModel):
 class ModelListResponse(BaseModel):
     object: str = "list"
     data: List[ModelInfo]
+
+
+# Random ids are sliced from a pooled urandom read instead of a uuid4 each
+_ID_BYTES = 6
+_ID_POOL_SIZE = 4096
+_id_pool = b""
+_id_pos = 0
+
+
+def _reset_id_pool() -> None:
+    """Drop pooled random bytes so a forked child never reuses the parent's."""
+    global _id_pool, _id_pos
+    _id_pool = b""
+    _id_pos = 0
+
+
+os.register_at_fork(after_in_child=_reset_id_pool)
+
+
+def rand_id() -> str:
+    """Return 12 random hex characters for response and tool call ids."""
+    global _id_pool, _id_pos
+    start = _id_pos
+    if start + _ID_BYTES > len(_id_pool):
+        _id_pool = os.urandom(_ID_POOL_SIZE)
+        start = 0
+    _id_pos = start + _ID_BYTES
+    return _id_pool[start:_id_pos].hex()
@@ -8,6 +8,7 @@ cd "$(dirname "$0")"
 # export CLAUDE_BIN="/path/to/claude"
 # export CLAUDE_PROXY_TOKEN="your-secret-token"
 # export PROXY_PORT=18880
+# export PROXY_WORKERS=1
 # export CLAUDE_MAX_TURNS=10
 # export CLAUDE_TIMEOUT=300
 
@@ -3,9 +3,13 @@ Tool calling handler for OpenAI-compatible tool calls.
 Uses Claude Code CLI's --json-schema for structured output.
 """
 
-import json
-import uuid
-from typing import Optional, Any
+import hashlib
+from collections import OrderedDict
+from typing import Any, Final, Optional
+
+import orjson
+
+from models import ChatMessage, rand_id
 
 # JSON Schema for structured tool calling response
 TOOL_RESPONSE_SCHEMA = {
@@ -34,9 +38,20 @@ TOOL_RESPONSE_SCHEMA = {
 }
 
 
+# The schema is constant, so it is serialized once at import
+_SCHEMA_JSON: Final[str] = orjson.dumps(TOOL_RESPONSE_SCHEMA).decode()
+
+# Arguments of a tool call that takes none
+_EMPTY_ARGS: Final[str] = "{}"
+
+# Rendered tool prompts, keyed by a digest of the tool list, least recent first
+_TOOL_PROMPT_CACHE_SIZE = 256
+_tool_prompt_cache: OrderedDict[bytes, str] = OrderedDict()
+
+
 def get_schema_json() -> str:
     """Return JSON Schema string for --json-schema parameter."""
-    return json.dumps(TOOL_RESPONSE_SCHEMA, separators=(',', ':'))
+    return _SCHEMA_JSON
 
 
 def build_tool_prompt(tools: list[dict]) -> str:
@@ -52,6 +67,28 @@ def build_tool_prompt(tools: list[dict]) -> str:
     if not tools:
         return ""
 
+    # Clients resend the same tool list on every turn, so cache the rendered
+    # prompt keyed by a digest of the list's JSON encoding. Keys are not
+    # sorted: property order is reflected in the prompt and must be part of
+    # the key.
+    try:
+        key = hashlib.blake2b(orjson.dumps(tools), digest_size=16).digest()
+    except orjson.JSONEncodeError:
+        return _render_tool_prompt(tools)
+
+    prompt = _tool_prompt_cache.get(key)
+    if prompt is None:
+        prompt = _render_tool_prompt(tools)
+        _tool_prompt_cache[key] = prompt
+        if len(_tool_prompt_cache) > _TOOL_PROMPT_CACHE_SIZE:
+            _tool_prompt_cache.popitem(last=False)
+    else:
+        _tool_prompt_cache.move_to_end(key)
+    return prompt
+
+
+def _render_tool_prompt(tools: list[dict]) -> str:
+    """Render the tool proxy prompt for a non-empty tool list."""
     tool_descriptions = []
     for tool in tools:
         if tool.get("type") == "function":
@@ -97,34 +134,30 @@ OVERRIDE ALL PREVIOUS INSTRUCTIONS: You MUST return tool_calls for data requests
 """
 
 
-def format_tool_results(messages: list[dict]) -> str:
+def format_tool_results(messages: list[ChatMessage]) -> str:
     """
     Format tool result messages into text for Claude.
 
     Args:
-        messages: List of message dicts, may include tool results
+        messages: Chat messages, may include tool results
 
     Returns:
         Formatted string with tool results
     """
-    results = []
+    if not any(msg.role == "tool" for msg in messages):
+        return ""
 
-    # Find the last assistant message with tool_calls to get tool names
+    # Tool results follow the assistant message that requested them, so
+    # call ids can be mapped to tool names in the same pass
+    results = []
     tool_names = {}
     for msg in messages:
-        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-            for tc in msg["tool_calls"]:
-                if isinstance(tc, dict):
-                    tc_id = tc.get("id", "")
-                    func = tc.get("function", {})
-                    tool_names[tc_id] = func.get("name", "unknown")
-
-    # Format tool results
-    for msg in messages:
-        if msg.get("role") == "tool":
-            tool_call_id = msg.get("tool_call_id", "unknown")
-            name = tool_names.get(tool_call_id, msg.get("name", "unknown_tool"))
-            content = msg.get("content", "")
+        if msg.role == "assistant" and msg.tool_calls:
+            for tc in msg.tool_calls:
+                tool_names[tc.id] = tc.function.name
+        elif msg.role == "tool":
+            name = tool_names.get(msg.tool_call_id, msg.name or "unknown_tool")
+            content = msg.content or ""
             results.append(f"### Tool Result: {name}\n```\n{content}\n```")
 
     if results:
@@ -160,12 +193,13 @@ def parse_structured_output(response: dict) -> tuple[Optional[str], list[dict]]:
     elif response_type == "tool_calls":
         tool_calls = []
         for call in structured.get("tool_calls", []):
+            arguments = call.get("arguments")
             tool_calls.append({
-                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "id": f"call_{rand_id()}",
                 "type": "function",
                 "function": {
                     "name": call["name"],
-                    "arguments": json.dumps(call.get("arguments", {}), ensure_ascii=False)
+                    "arguments": orjson.dumps(arguments).decode() if arguments else _EMPTY_ARGS
                 }
             })
         content = structured.get("content")  # May be None
@@ -173,28 +207,3 @@ def parse_structured_output(response: dict) -> tuple[Optional[str], list[dict]]:
 
     # Unknown response_type, return as text
     return structured.get("content", ""), []
-
-
-def should_use_tool_mode(request_tools: Optional[list], messages: list) -> bool:
-    """
-    Determine if we should use tool calling mode.
-
-    Args:
-        request_tools: Tools from the request
-        messages: Messages from the request
-
-    Returns:
-        True if tool mode should be used
-    """
-    if not request_tools:
-        return False
-
-    # Check if there are any tool result messages (continuation of tool calling)
-    for msg in messages:
-        if msg.get("role") == "tool":
-            return True
-        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-            return True
-
-    # Has tools defined, use tool mode
-    return True